@@ -5,7 +5,12 @@ This file initializes the Flask app and its extensions
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_caching import Cache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 import os
+import logging
+from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -14,6 +19,8 @@ load_dotenv()
 # Initialize Flask extensions
 db = SQLAlchemy()
 login_manager = LoginManager()
+cache = Cache()
+limiter = Limiter(key_func=get_remote_address)
 
 
 class Config:
@@ -24,12 +31,30 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production-2024'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///bank.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'query_cache_size': 1200  # Compiled statement cache entries (default 500)
+    }
     
     # Session configuration
     PERMANENT_SESSION_LIFETIME = 1800  # 30 minutes
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     
+    # Cache configuration (Redis when REDIS_URL is set, in-process otherwise)
+    REDIS_URL = os.environ.get('REDIS_URL')
+    CACHE_TYPE = 'RedisCache' if REDIS_URL else 'SimpleCache'
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_DEFAULT_TIMEOUT = 60  # seconds
+    # Caches that rely on explicit invalidation (user snapshots, unknown emails,
+    # account choices) are only correct when every worker sees the same cache
+    CACHE_SHARED = CACHE_TYPE != 'SimpleCache'
+    
+    # Server-side sessions in Redis when REDIS_URL is set, signed cookies otherwise
+    SESSION_TYPE = 'redis' if REDIS_URL else None
+    
+    # Rate limit counters, shared across workers when Redis is available
+    RATELIMIT_STORAGE_URI = REDIS_URL or 'memory://'
+    
     # WTForms configuration
     WTF_CSRF_ENABLED = True
     WTF_CSRF_TIME_LIMIT = None  # No time limit for CSRF tokens
@@ -57,9 +82,34 @@ def create_app(config_class=Config):
     except OSError:
         pass
     
+    # Log errors to a rotating file in the instance folder (opened on first write)
+    if not app.testing:
+        file_handler = RotatingFileHandler(
+            os.path.join(app.instance_path, 'bank.log'),
+            maxBytes=1024 * 1024,
+            backupCount=5,
+            delay=True
+        )
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+        ))
+        file_handler.setLevel(logging.INFO)
+        app.logger.addHandler(file_handler)
+        app.logger.setLevel(logging.INFO)
+    
     # Initialize extensions with app
     db.init_app(app)
     login_manager.init_app(app)
+    cache.init_app(app)
+    limiter.init_app(app)
+    
+    # Store sessions in Redis so the cookie only carries a session id
+    if app.config.get('SESSION_TYPE') == 'redis':
+        import redis
+        from flask_session import Session
+        
+        app.config.setdefault('SESSION_REDIS', redis.Redis.from_url(app.config['REDIS_URL']))
+        Session(app)
     
     # Configure Flask-Login
     login_manager.login_view = 'auth.login'
@@ -71,17 +121,33 @@ def create_app(config_class=Config):
     def load_user(user_id):
         """
         Load user by ID for Flask-Login
-        Checks both User and Admin tables
+        Checks both User and Admin tables, caching the row briefly
         """
         from app.models import User, Admin
+        from app.caching import USER_KEY, USER_TIMEOUT, shared_cache_enabled, user_snapshot, restore_user
         
         # Check if it's a user or admin based on ID format
         # Users have regular IDs, we'll use a prefix system
         if user_id.startswith('admin_'):
-            admin_id = int(user_id.split('_')[1])
-            return Admin.query.get(admin_id)
+            model, primary_key = Admin, int(user_id.split('_')[1])
         else:
-            return User.query.get(int(user_id))
+            model, primary_key = User, int(user_id)
+        
+        if not shared_cache_enabled():
+            return db.session.get(model, primary_key)
+        
+        # Rebuild from a cached snapshot without going back to the database
+        cache_key = USER_KEY.format(user_id=user_id)
+        snapshot = cache.get(cache_key)
+        if snapshot is not None:
+            return restore_user(model, snapshot)
+        
+        user = db.session.get(model, primary_key)
+        
+        if user is not None:
+            cache.set(cache_key, user_snapshot(user), timeout=USER_TIMEOUT)
+        
+        return user
     
     # Create database tables and default admin
     with app.app_context():
@@ -93,15 +159,14 @@ def create_app(config_class=Config):
         
         # Create default admin if not exists
         from app.models import Admin
-        from werkzeug.security import generate_password_hash
         
         admin = Admin.query.filter_by(username='admin').first()
         if not admin:
             default_admin = Admin(
                 username='admin',
-                email='admin@banking.com',
-                password=generate_password_hash('admin123', method='pbkdf2:sha256')
+                email='admin@banking.com'
             )
+            default_admin.set_password('admin123')
             db.session.add(default_admin)
             db.session.commit()
             print("=" * 60)
@@ -119,6 +184,13 @@ def create_app(config_class=Config):
     app.register_blueprint(user_routes.bp)
     app.register_blueprint(admin_routes.bp)
     
+    # Template filters
+    from app.models import to_ist, clear_request_lookups
+    app.add_template_filter(to_ist)
+    
+    # Reset per-request lookup memos
+    app.teardown_request(clear_request_lookups)
+    
     # Root route
     @app.route('/')
     def index():
@@ -0,0 +1,108 @@
+"""
+Banking Management System - Cache Helpers
+Cache keys and invalidation helpers shared by the route blueprints
+"""
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from app import db, cache
+
+# Admin dashboard aggregate counters
+ADMIN_METRICS_KEY = 'admin:metrics'
+
+# Admin transactions page count/volume, per (type, date, search) filter
+ADMIN_TRANSACTION_TOTALS_KEY = 'admin:transaction_totals:{transaction_type}:{date_filter}:{search_query}'
+
+# Statistics page "users with most transactions" ranking, refreshed hourly
+ADMIN_TOP_USERS_KEY = 'admin:top_users'
+ADMIN_TOP_USERS_TIMEOUT = 3600  # seconds
+
+# Flask-Login user loader snapshots, keyed on the session user id ('5', 'admin_1')
+USER_KEY = 'user:{user_id}'
+USER_TIMEOUT = 60  # seconds
+USER_SECRET_COLUMNS = ('password_hash', 'password')  # Never written to the cache
+
+# Transfer/deposit/withdraw dropdown labels for a user's active accounts
+ACCOUNT_CHOICES_KEY = 'choices:{user_id}'
+ACCOUNT_CHOICES_TIMEOUT = 300  # seconds
+
+# Emails that recently failed a login lookup, so repeated attempts skip the SELECT
+NO_EMAIL_KEY = 'noemail:{email}'
+NO_EMAIL_TIMEOUT = 30  # seconds
+
+
+def shared_cache_enabled():
+    """
+    Whether invalidation-based caches may be used
+    With the per-process SimpleCache, an invalidation in one gunicorn worker
+    would leave stale entries in the others, so those caches are skipped
+    
+    Returns:
+        bool: True when the cache backend is shared by all workers (Redis)
+    """
+    return current_app.config.get('CACHE_SHARED', False)
+
+
+def invalidate_admin_metrics():
+    """
+    Drop the cached admin dashboard counters
+    Call after any commit that changes users, accounts, or transactions
+    """
+    cache.delete(ADMIN_METRICS_KEY)
+
+
+def invalidate_account_choices(*user_ids):
+    """
+    Drop the cached account dropdown choices for one or more users
+    Call after any commit that changes an account's balance, status, or existence;
+    balance updates are Core UPDATEs, so no ORM event would notice them
+    
+    Args:
+        *user_ids (int): Owners of the changed accounts
+    """
+    cache.delete_many(*(ACCOUNT_CHOICES_KEY.format(user_id=user_id) for user_id in user_ids))
+
+
+def user_snapshot(user):
+    """
+    Column values of a User or Admin that are safe to keep in a shared cache
+    Password hashes are left out and load on demand after restore_user()
+    
+    Args:
+        user: Loaded User or Admin instance
+        
+    Returns:
+        dict: Column name to value, without secret columns
+    """
+    return {
+        attr.key: getattr(user, attr.key)
+        for attr in inspect(user).mapper.column_attrs
+        if attr.key not in USER_SECRET_COLUMNS
+    }
+
+
+def restore_user(model, snapshot):
+    """
+    Rebuild a session-bound User or Admin from a cached snapshot without a query
+    
+    Args:
+        model: User or Admin class
+        snapshot (dict): Values from user_snapshot()
+        
+    Returns:
+        Persistent instance; columns missing from the snapshot load when accessed
+    """
+    user = model(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    """
+    Drop the cached user loader entry for a user or admin
+    Call after any commit that changes password, status, or profile fields
+    
+    Args:
+        user_id (str): Flask-Login id, as returned by get_id()
+    """
+    cache.delete(USER_KEY.format(user_id=user_id))
@@ -5,7 +5,11 @@ Defines all forms used in the application
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField, DecimalField, TextAreaField, IntegerField
 from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length, Optional, NumberRange
-from app.models import User, Account
+from app.models import find_user_by_email, find_account_by_number
+import re
+
+# Account numbers are exactly 10 digits
+ACCOUNT_NUMBER_RE = re.compile(r'\d{10}')
 
 
 class RegisterForm(FlaskForm):
@@ -34,7 +38,7 @@ class RegisterForm(FlaskForm):
         """
         Custom validator to check if email already exists
         """
-        user = User.query.filter_by(email=email.data.lower().strip()).first()
+        user = find_user_by_email(email.data)
         if user:
             raise ValidationError('Email already registered. Please use a different email or login.')
 
@@ -61,7 +65,8 @@ class TransferForm(FlaskForm):
     """
     Money transfer form
     """
-    from_account = SelectField('From Account', coerce=int, validators=[
+    # Ownership is checked in the view when the selected account is loaded
+    from_account = SelectField('From Account', coerce=int, validate_choice=False, validators=[
         DataRequired(message='Please select source account')
     ])
     
@@ -85,11 +90,14 @@ class TransferForm(FlaskForm):
     def validate_to_account_id(self, to_account_id):
         """
         Validate that destination account exists and is not frozen
+        Malformed input is rejected before touching the database
         """
-        if not to_account_id.data.isdigit():
+        if not ACCOUNT_NUMBER_RE.fullmatch(to_account_id.data):
+            if to_account_id.errors:
+                return  # Length already reported the problem
             raise ValidationError('Account number must contain only digits.')
         
-        account = Account.query.filter_by(account_number=to_account_id.data).first()
+        account = find_account_by_number(to_account_id.data)
         if not account:
             raise ValidationError('Account number does not exist.')
         
@@ -120,7 +128,7 @@ class CreateAccountForm(FlaskForm):
     Create new bank account form
     """
     account_type = SelectField('Account Type', choices=[
-        ('Current', 'Current Account'),
+        ('current', 'Current Account'),
         ('savings', 'Savings Account')
     ], validators=[DataRequired(message='Please select account type')])
     
@@ -157,7 +165,8 @@ class DepositForm(FlaskForm):
     """
     Deposit money form (for admin or self-deposit simulation)
     """
-    account = SelectField('Account', coerce=int, validators=[
+    # Ownership is checked in the view when the selected account is loaded
+    account = SelectField('Account', coerce=int, validate_choice=False, validators=[
         DataRequired(message='Please select account')
     ])
     
@@ -178,7 +187,8 @@ class WithdrawForm(FlaskForm):
     """
     Withdraw money form
     """
-    account = SelectField('Account', coerce=int, validators=[
+    # Ownership is checked in the view when the selected account is loaded
+    account = SelectField('Account', coerce=int, validate_choice=False, validators=[
         DataRequired(message='Please select account')
     ])
     
@@ -3,14 +3,171 @@ Banking Management System - Database Models
 Defines all database tables and relationships using SQLAlchemy
 """
 from app import db
+from flask import g
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-# from datetime import datetime
-from datetime import datetime, timedelta
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from sqlalchemy import func, event, select, update, DDL
+from sqlalchemy.orm import validates, column_property, selectinload
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import random
+import secrets
+import hmac
 
 
-def get_ist_now():
-    return datetime.utcnow() + timedelta(hours=5, minutes=30)
+# Timestamps are stored in UTC by the database; IST is applied for display only
+IST = timezone(timedelta(hours=5, minutes=30), 'IST')
+
+
+def to_ist(value):
+    """
+    Convert a stored UTC timestamp to India Standard Time
+    Registered as the `to_ist` Jinja filter
+    
+    Args:
+        value (datetime): UTC timestamp (naive values are treated as UTC)
+        
+    Returns:
+        datetime: Timezone-aware IST timestamp, or None
+    """
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(IST)
+
+
+def ist_today_start():
+    """
+    Get midnight of the current IST day as a UTC timestamp
+    
+    Returns:
+        datetime: Start of today (IST) in UTC, for range filters on stored timestamps
+    """
+    today_ist = datetime.now(IST).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today_ist.astimezone(timezone.utc)
+
+
+# Trigram (pg_trgm) GIN indexes back the admin "contains" searches on PostgreSQL
+# so ILIKE '%q%' can use an index; other databases skip them
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
+
+def trigram_index(name, column):
+    """
+    Build a PostgreSQL-only GIN trigram index on a text column
+    
+    Args:
+        name (str): Index name
+        column (str): Column name
+        
+    Returns:
+        Index: Index that is only created on PostgreSQL
+    """
+    return db.Index(
+        name,
+        column,
+        postgresql_using='gin',
+        postgresql_ops={column: 'gin_trgm_ops'}
+    ).ddl_if(dialect='postgresql')
+
+
+# Argon2id parameters tuned for interactive logins (64 MiB, 2 passes)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+
+def hash_password(password):
+    """
+    Hash a password with Argon2id
+    
+    Args:
+        password (str): Plain text password
+        
+    Returns:
+        str: Encoded Argon2id hash
+    """
+    return password_hasher.hash(password)
+
+
+def check_password(stored_hash, password):
+    """
+    Verify a password against a stored hash in constant time
+    Accepts Argon2id hashes and legacy Werkzeug pbkdf2 hashes
+    
+    Args:
+        stored_hash (str): Hash from the database
+        password (str): Plain text password to verify
+        
+    Returns:
+        tuple: (matches, needs_rehash) - needs_rehash is True when a matching
+               hash is legacy or uses outdated Argon2 parameters
+    """
+    if not stored_hash.startswith('$argon2'):
+        return check_password_hash(stored_hash, password), True
+    try:
+        password_hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False, False
+    return True, password_hasher.check_needs_rehash(stored_hash)
+
+
+@lru_cache(maxsize=1)
+def dummy_password_hash():
+    """
+    Argon2id hash of a random secret, computed once per process
+    
+    Returns:
+        str: Encoded Argon2id hash that no password matches
+    """
+    return hash_password(secrets.token_urlsafe(32))
+
+
+def dummy_check_password(password):
+    """
+    Spend the same time as check_password when no user matched
+    Keeps unknown and known emails indistinguishable by response time
+    
+    Args:
+        password (str): Plain text password that was submitted
+    """
+    check_password(dummy_password_hash(), password)
+
+
+def normalize_email(email):
+    """
+    Canonical form of an email address (stripped, lowercase)
+    
+    Args:
+        email (str): Email address as entered
+        
+    Returns:
+        str: Normalized email address
+    """
+    return email.strip().lower()
+
+
+def secure_equals(a, b):
+    """
+    Constant-time string comparison for secrets (tokens, hashes)
+    Never compare secrets with == as it returns early on the first mismatch
+    Nothing calls this yet; it is reserved for future token checks (reset links,
+    API keys). Passwords go through check_password, whose Argon2 and pbkdf2
+    verifiers are already constant-time
+    
+    Args:
+        a (str): First value
+        b (str): Second value
+        
+    Returns:
+        bool: True if both values are equal
+    """
+    return hmac.compare_digest(a.encode(), b.encode())
 
 
 class User(UserMixin, db.Model):
@@ -18,6 +175,12 @@ class User(UserMixin, db.Model):
     User model - represents regular banking customers
     """
     __tablename__ = 'users'
+    __table_args__ = (
+        trigram_index('ix_users_email_trgm', 'email'),
+        trigram_index('ix_users_full_name_trgm', 'full_name'),
+        # Emails are stored lowercase so the unique index is case-insensitive
+        db.CheckConstraint('email = lower(email)', name='ck_users_email_lowercase'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
@@ -26,10 +189,17 @@ class User(UserMixin, db.Model):
     phone = db.Column(db.String(20), nullable=True)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     is_active = db.Column(db.Boolean, default=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=get_ist_now, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
     
     # Relationships
-    accounts = db.relationship('Account', backref='owner', lazy='dynamic', cascade='all, delete-orphan')
+    accounts = db.relationship('Account', backref='owner', lazy='select', cascade='all, delete-orphan')
+    
+    @validates('email')
+    def validate_email(self, key, email):
+        """
+        Normalize email on assignment, whatever code path sets it
+        """
+        return normalize_email(email)
     
     def set_password(self, password):
         """
@@ -38,11 +208,12 @@ class User(UserMixin, db.Model):
         Args:
             password (str): Plain text password
         """
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password_hash = hash_password(password)
     
     def verify_password(self, password):
         """
         Verify if the provided password matches the stored hash
+        Upgrades legacy hashes on success (caller commits)
         
         Args:
             password (str): Plain text password to verify
@@ -50,7 +221,10 @@ class User(UserMixin, db.Model):
         Returns:
             bool: True if password matches, False otherwise
         """
-        return check_password_hash(self.password_hash, password)
+        matches, needs_rehash = check_password(self.password_hash, password)
+        if matches and needs_rehash:
+            self.set_password(password)
+        return matches
     
     def get_id(self):
         """
@@ -64,17 +238,32 @@ class User(UserMixin, db.Model):
     def get_total_balance(self):
         """
         Calculate total balance across all user accounts
+        Sums in the database so no Account rows are loaded
         
         Returns:
             float: Total balance in dollars
         """
-        total_cents = sum(account.balance for account in self.accounts)
-        return total_cents / 100.0
+        total_cents = db.session.query(func.sum(Account.balance)).filter(
+            Account.user_id == self.id
+        ).scalar()
+        return (total_cents or 0) / 100.0
     
     def __repr__(self):
         return f'<User {self.email}>'
 
 
+# Inactive users are the rare case, so index only those rows, newest first (id breaks
+# ties) for the admin "inactive" filter. The predicate is built from the column so it
+# matches the "is_active = 0" / "is_active = false" the ORM emits, which the planner requires
+db.Index(
+    'ix_users_inactive',
+    User.created_at.desc(),
+    User.id.desc(),
+    postgresql_where=User.is_active == False,
+    sqlite_where=User.is_active == False
+)
+
+
 class Admin(UserMixin, db.Model):
     """
     Admin model - represents system administrators
@@ -86,7 +275,7 @@ class Admin(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=get_ist_now, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
     
     def get_id(self):
         """
@@ -101,6 +290,7 @@ class Admin(UserMixin, db.Model):
     def verify_password(self, password):
         """
         Verify admin password
+        Upgrades legacy hashes on success (caller commits)
         
         Args:
             password (str): Plain text password to verify
@@ -108,7 +298,10 @@ class Admin(UserMixin, db.Model):
         Returns:
             bool: True if password matches, False otherwise
         """
-        return check_password_hash(self.password, password)
+        matches, needs_rehash = check_password(self.password, password)
+        if matches and needs_rehash:
+            self.set_password(password)
+        return matches
     
     def set_password(self, password):
         """
@@ -117,7 +310,7 @@ class Admin(UserMixin, db.Model):
         Args:
             password (str): Plain text password
         """
-        self.password = generate_password_hash(password, method='pbkdf2:sha256')
+        self.password = hash_password(password)
     
     def __repr__(self):
         return f'<Admin {self.username}>'
@@ -128,14 +321,28 @@ class Account(db.Model):
     Account model - represents bank accounts owned by users
     """
     __tablename__ = 'accounts'
+    __table_args__ = (
+        # Covers lookups by owner and lets "account ids for a user" be answered from the index
+        db.Index('ix_accounts_user_id_id', 'user_id', 'id'),
+        trigram_index('ix_accounts_account_number_trgm', 'account_number'),
+        # Only two account types: enforce them, and index the smaller group only
+        db.CheckConstraint("account_type IN ('current', 'savings')", name='ck_accounts_account_type'),
+        db.Index(
+            'ix_accounts_savings',
+            'id',
+            postgresql_where=db.text("account_type = 'savings'"),
+            sqlite_where=db.text("account_type = 'savings'")
+        ),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     account_number = db.Column(db.String(20), unique=True, nullable=False, index=True)
-    account_type = db.Column(db.String(20), nullable=False)  # 'checking' or 'savings'
+    account_type = db.Column(db.String(20), nullable=False)  # 'current' or 'savings'
     balance = db.Column(db.Integer, default=0, nullable=False)  # Stored in cents
+    balance_dollars = column_property(balance / 100.0)  # Scaled by the database on load
     is_frozen = db.Column(db.Boolean, default=False, nullable=False)
-    created_at = db.Column(db.DateTime, default=get_ist_now, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
     
     # Relationships
     transactions_sent = db.relationship(
@@ -151,6 +358,13 @@ class Account(db.Model):
         lazy='dynamic'
     )
     
+    @validates('account_type')
+    def validate_account_type(self, key, account_type):
+        """
+        Store account types lowercase so filters and the CHECK constraint agree
+        """
+        return account_type.strip().lower()
+    
     def get_balance(self):
         """
         Get account balance in dollars
@@ -160,41 +374,30 @@ class Account(db.Model):
         """
         return self.balance / 100.0
     
-    def deposit(self, amount_cents):
-        """
-        Deposit money into account
-        
-        Args:
-            amount_cents (int): Amount to deposit in cents
-        """
-        self.balance += amount_cents
-    
-    def withdraw(self, amount_cents):
+    def get_all_transactions(self, limit=None):
         """
-        Withdraw money from account
+        Get all transactions (sent and received) for this account
+        Fetched with one query, ordered (and optionally limited) by the database;
+        both related accounts are batch-loaded so rendering them adds no queries
         
         Args:
-            amount_cents (int): Amount to withdraw in cents
-            
-        Returns:
-            bool: True if successful, False if insufficient funds
-        """
-        if self.balance >= amount_cents:
-            self.balance -= amount_cents
-            return True
-        return False
-    
-    def get_all_transactions(self):
-        """
-        Get all transactions (sent and received) for this account
+            limit (int): Maximum number of transactions to return (None for all)
         
         Returns:
-            list: Combined list of transactions, sorted by timestamp
+            list: Combined list of transactions, most recent first
         """
-        sent = self.transactions_sent.all()
-        received = self.transactions_received.all()
-        all_transactions = sent + received
-        return sorted(all_transactions, key=lambda x: x.timestamp, reverse=True)
+        query = Transaction.query.options(
+            selectinload(Transaction.source_account),
+            selectinload(Transaction.destination_account)
+        ).filter(
+            db.or_(
+                Transaction.from_account_id == self.id,
+                Transaction.to_account_id == self.id
+            )
+        ).order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
     
     def __repr__(self):
         return f'<Account {self.account_number}>'
@@ -205,14 +408,24 @@ class Transaction(db.Model):
     Transaction model - represents money transfers between accounts
     """
     __tablename__ = 'transactions'
+    __table_args__ = (
+        trigram_index('ix_transactions_description_trgm', 'description'),
+        # Serves "type = X AND timestamp >= cutoff ORDER BY timestamp DESC, id DESC" without a sort
+        db.Index('ix_transactions_type_timestamp', 'transaction_type', db.text('timestamp DESC'), db.text('id DESC')),
+        # Per-account history, newest first, straight from the index
+        # (id breaks timestamp ties, matching every newest-first ORDER BY); they also
+        # serve plain account_id lookups, so the foreign keys need no index of their own
+        db.Index('ix_transactions_from_account_timestamp', 'from_account_id', db.text('timestamp DESC'), db.text('id DESC')),
+        db.Index('ix_transactions_to_account_timestamp', 'to_account_id', db.text('timestamp DESC'), db.text('id DESC')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    from_account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=True, index=True)
-    to_account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=True, index=True)
+    from_account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=True)
+    to_account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=True)
     amount = db.Column(db.Integer, nullable=False)  # Stored in cents
     transaction_type = db.Column(db.String(20), nullable=False)  # 'transfer', 'deposit', 'withdrawal'
     description = db.Column(db.String(255), nullable=True)
-    timestamp = db.Column(db.DateTime, default=get_ist_now, nullable=False, index=True)
+    timestamp = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
     
     def get_amount(self):
         """
@@ -227,19 +440,144 @@ class Transaction(db.Model):
         return f'<Transaction {self.id} - {self.transaction_type} ₹{self.get_amount():.2f}>'
 
 
+# Request-scoped lookups shared by form validators and route handlers
+def find_user_by_email(email):
+    """
+    Find a user by email, memoized for the current request
+    
+    Args:
+        email (str): Email address (normalized here)
+        
+    Returns:
+        User: Matching user, or None
+    """
+    email = normalize_email(email)
+    lookups = g.setdefault('users_by_email', {})
+    if email not in lookups:
+        lookups[email] = db.session.execute(
+            select(User).where(User.email == email)
+        ).scalar_one_or_none()
+    return lookups[email]
+
+
+def find_account_by_number(account_number):
+    """
+    Find an account by account number, memoized for the current request
+    
+    Args:
+        account_number (str): 10-digit account number
+        
+    Returns:
+        Account: Matching account, or None
+    """
+    lookups = g.setdefault('accounts_by_number', {})
+    if account_number not in lookups:
+        lookups[account_number] = db.session.execute(
+            select(Account).where(Account.account_number == account_number)
+        ).scalar_one_or_none()
+    return lookups[account_number]
+
+
+def debit_account(account_id, amount_cents):
+    """
+    Atomically take money out of an active account with enough funds
+    Runs as a single conditional UPDATE, so concurrent debits cannot overdraw
+    
+    Args:
+        account_id (int): Account to debit
+        amount_cents (int): Amount in cents
+        
+    Returns:
+        bool: True if the account was debited
+    """
+    result = db.session.execute(
+        update(Account)
+        .where(
+            Account.id == account_id,
+            Account.is_frozen.is_(False),
+            Account.balance >= amount_cents
+        )
+        .values(balance=Account.balance - amount_cents)
+    )
+    return result.rowcount == 1
+
+
+def credit_account(account_id, amount_cents):
+    """
+    Atomically add money to an active account
+    
+    Args:
+        account_id (int): Account to credit
+        amount_cents (int): Amount in cents
+        
+    Returns:
+        bool: True if the account was credited
+    """
+    result = db.session.execute(
+        update(Account)
+        .where(Account.id == account_id, Account.is_frozen.is_(False))
+        .values(balance=Account.balance + amount_cents)
+    )
+    return result.rowcount == 1
+
+
+def transfer_funds(from_account_id, to_account_id, amount_cents):
+    """
+    Atomically move money between two accounts with conditional UPDATEs
+    Rows are updated in account-id order, so concurrent opposite transfers
+    (A to B and B to A) take their row locks in the same order and cannot deadlock
+    
+    Args:
+        from_account_id (int): Account to debit
+        to_account_id (int): Account to credit
+        amount_cents (int): Amount in cents
+        
+    Returns:
+        str: None on success, otherwise 'debit' or 'credit' for the UPDATE
+             that matched no row (the caller must roll back)
+    """
+    steps = sorted([
+        (from_account_id, 'debit', debit_account),
+        (to_account_id, 'credit', credit_account)
+    ], key=lambda step: step[0])
+    for account_id, step, apply in steps:
+        if not apply(account_id, amount_cents):
+            return step
+    return None
+
+
+def clear_request_lookups(exception=None):
+    """
+    Drop the request-scoped lookups at the end of a request
+    Registered as a teardown_request handler, since g outlives the request
+    whenever an app context was already pushed (e.g. in tests)
+    """
+    g.pop('users_by_email', None)
+    g.pop('accounts_by_number', None)
+
+
 # Helper function to generate unique account numbers
-def generate_account_number():
+def generate_account_number(batch_size=8):
     """
     Generate a unique 10-digit account number
+    Draws a batch of candidates and checks them all with a single query
+    
+    Args:
+        batch_size (int): Number of candidates to check per round trip
     
     Returns:
         str: Unique account number
     """
-    import random
+    rng = random.SystemRandom()
     while True:
-        # Generate 10-digit number
-        account_num = ''.join([str(random.randint(0, 9)) for _ in range(10)])
-        # Check if it already exists
-        existing = Account.query.filter_by(account_number=account_num).first()
-        if not existing:
-            return account_num
\ No newline at end of file
+        # Generate 10-digit numbers (no leading zero)
+        candidates = [str(rng.randrange(10**9, 10**10)) for _ in range(batch_size)]
+        # Find which of them already exist
+        taken = {
+            row[0] for row in db.session.query(Account.account_number).filter(
+                Account.account_number.in_(candidates)
+            )
+        }
+        for account_num in candidates:
+            if account_num not in taken:
+                return account_num
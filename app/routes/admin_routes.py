@@ -5,10 +5,18 @@ Handles admin dashboard, user management, and transaction monitoring
 from flask import Blueprint, render_template, redirect, url_for, flash, request, abort
 from flask_login import login_required, current_user
 from functools import wraps
-from app import db
-from app.models import User, Admin, Account, Transaction
-from datetime import datetime, timedelta
-from sqlalchemy import func, desc
+from app import db, cache
+from app.caching import (
+    ADMIN_METRICS_KEY, ADMIN_TRANSACTION_TOTALS_KEY, ADMIN_TOP_USERS_KEY, ADMIN_TOP_USERS_TIMEOUT,
+    invalidate_admin_metrics, invalidate_account_choices, invalidate_user
+)
+from app.models import User, Admin, Account, Transaction, ist_today_start
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, desc, case
+from sqlalchemy.orm import selectinload, raiseload
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create Blueprint
 bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -41,6 +49,85 @@ def admin_required(f):
     return decorated_function
 
 
+def account_number_prefix_filter(search_query):
+    """
+    Build the account-number predicate for a search string
+    Account numbers are typed left to right, so a prefix match covers real
+    searches. It is written as a range rather than LIKE 'q%', which SQLite
+    (case-insensitive LIKE) can't turn into an index search
+    
+    Args:
+        search_query (str): Search text entered by the admin
+    
+    Returns:
+        Range clause on account_number, or None if the text can't match any account number
+    """
+    if not search_query.isdigit():
+        return None
+    # The next string after every "q..." value: bump the last character
+    upper_bound = search_query[:-1] + chr(ord(search_query[-1]) + 1)
+    return db.and_(
+        Account.account_number >= search_query,
+        Account.account_number < upper_bound
+    )
+
+
+def get_dashboard_metrics():
+    """
+    Compute the admin dashboard summary counters
+    Results are cached for CACHE_DEFAULT_TIMEOUT seconds and dropped by
+    invalidate_admin_metrics() whenever a write changes them
+    
+    Returns:
+        dict: Counter name -> value, passed straight to the template
+    """
+    metrics = cache.get(ADMIN_METRICS_KEY)
+    if metrics is not None:
+        return metrics
+    
+    # Users by status (one grouped scan instead of three counts)
+    user_counts = dict(
+        db.session.query(User.is_active, func.count(User.id)).group_by(User.is_active).all()
+    )
+    active_users = user_counts.get(True, 0)
+    inactive_users = user_counts.get(False, 0)
+    total_users = active_users + inactive_users
+    
+    # Accounts by frozen status, with their balances (scaled to rupees in SQL)
+    account_rows = db.session.query(
+        Account.is_frozen,
+        func.count(Account.id),
+        func.sum(Account.balance) / 100.0
+    ).group_by(Account.is_frozen).all()
+    total_accounts = sum(count for _, count, _ in account_rows)
+    frozen_accounts = sum(count for is_frozen, count, _ in account_rows if is_frozen)
+    total_balance = sum(balance or 0 for _, _, balance in account_rows)
+    
+    # All-time and today's transaction totals in a single pass
+    today_start = ist_today_start()
+    is_today = Transaction.timestamp >= today_start
+    total_transactions, transactions_today, today_volume_cents = db.session.query(
+        func.count(Transaction.id),
+        func.count(case((is_today, Transaction.id))),
+        func.sum(case((is_today, Transaction.amount)))
+    ).one()
+    today_volume = (today_volume_cents or 0) / 100.0
+    
+    metrics = {
+        'total_users': total_users,
+        'active_users': active_users,
+        'inactive_users': inactive_users,
+        'total_accounts': total_accounts,
+        'frozen_accounts': frozen_accounts,
+        'total_balance': total_balance,
+        'total_transactions': total_transactions,
+        'transactions_today': transactions_today,
+        'today_volume': today_volume
+    }
+    cache.set(ADMIN_METRICS_KEY, metrics)
+    return metrics
+
+
 @bp.route('/dashboard')
 @login_required
 @admin_required
@@ -48,59 +135,24 @@ def dashboard():
     """
     Admin dashboard - displays summary metrics and system statistics
     """
-    # Total number of users
-    total_users = User.query.count()
-    
-    # Active users (is_active = True)
-    active_users = User.query.filter_by(is_active=True).count()
+    # Summary counters (cached briefly so polling admins don't rescan tables)
+    metrics = get_dashboard_metrics()
     
-    # Inactive/frozen users
-    inactive_users = User.query.filter_by(is_active=False).count()
-    
-    # Total number of accounts
-    total_accounts = Account.query.count()
-    
-    # Frozen accounts
-    frozen_accounts = Account.query.filter_by(is_frozen=True).count()
-    
-    # Total balance across all accounts (in cents, convert to dollars)
-    total_balance_cents = db.session.query(func.sum(Account.balance)).scalar() or 0
-    total_balance = total_balance_cents / 100.0
-    
-    # Total number of transactions
-    total_transactions = Transaction.query.count()
-    
-    # Transactions today
-    now_ist = datetime.utcnow() + timedelta(hours=5, minutes=30)
-    today_start = now_ist.replace(hour=0, minute=0, second=0, microsecond=0)
-    transactions_today = Transaction.query.filter(Transaction.timestamp >= today_start).count()
-    
-    # Total transaction volume today (in cents)
-    today_volume_cents = db.session.query(func.sum(Transaction.amount)).filter(
-        Transaction.timestamp >= today_start
-    ).scalar() or 0
-    today_volume = today_volume_cents / 100.0
-    
-    # Recent transactions (last 10)
-    recent_transactions = Transaction.query.order_by(desc(Transaction.timestamp)).limit(10).all()
+    # Recent transactions (last 10), with both accounts preloaded for the template
+    recent_transactions = Transaction.query.options(
+        selectinload(Transaction.source_account),
+        selectinload(Transaction.destination_account)
+    ).order_by(desc(Transaction.timestamp), desc(Transaction.id)).limit(10).all()
     
     # Recently registered users (last 5)
-    recent_users = User.query.order_by(desc(User.created_at)).limit(5).all()
+    recent_users = User.query.order_by(desc(User.created_at), desc(User.id)).limit(5).all()
     
     return render_template(
         'admin/dashboard.html',
         title='Admin Dashboard',
-        total_users=total_users,
-        active_users=active_users,
-        inactive_users=inactive_users,
-        total_accounts=total_accounts,
-        frozen_accounts=frozen_accounts,
-        total_balance=total_balance,
-        total_transactions=total_transactions,
-        transactions_today=transactions_today,
-        today_volume=today_volume,
         recent_transactions=recent_transactions,
-        recent_users=recent_users
+        recent_users=recent_users,
+        **metrics
     )
 
 
@@ -137,7 +189,7 @@ def users():
         )
     
     # Order by most recent first
-    query = query.order_by(desc(User.created_at))
+    query = query.order_by(desc(User.created_at), desc(User.id))
     
     # Paginate results
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
@@ -164,19 +216,30 @@ def user_details(user_id):
     Args:
         user_id (int): User ID to display
     """
-    user = User.query.get_or_404(user_id)
+    # Load the user and all of their accounts in two round trips; any other
+    # relationship access on the user raises instead of lazy loading
+    user = db.session.query(User).options(
+        selectinload(User.accounts),
+        raiseload('*')
+    ).filter_by(id=user_id).one_or_none()
+    if user is None:
+        abort(404)
     
     # Get all user accounts
-    accounts = user.accounts.all()
+    accounts = user.accounts
     
     # Get recent transactions for this user (across all accounts)
-    account_ids = [acc.id for acc in accounts]
-    recent_transactions = Transaction.query.filter(
+    # The user's account ids are resolved inside the same SQL statement
+    user_account_ids = db.select(Account.id).where(Account.user_id == user_id)
+    recent_transactions = Transaction.query.options(
+        selectinload(Transaction.source_account),
+        selectinload(Transaction.destination_account)
+    ).filter(
         db.or_(
-            Transaction.from_account_id.in_(account_ids),
-            Transaction.to_account_id.in_(account_ids)
+            Transaction.from_account_id.in_(user_account_ids),
+            Transaction.to_account_id.in_(user_account_ids)
         )
-    ).order_by(desc(Transaction.timestamp)).limit(20).all()
+    ).order_by(desc(Transaction.timestamp), desc(Transaction.id)).limit(20).all()
     
     # Calculate total balance
     total_balance = user.get_total_balance()
@@ -202,21 +265,23 @@ def toggle_user_status(user_id):
     Args:
         user_id (int): User ID to toggle
     """
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
     # Toggle the status
     user.is_active = not user.is_active
     
     try:
         db.session.commit()
+        invalidate_admin_metrics()
+        invalidate_user(user.get_id())
         
         status = "activated" if user.is_active else "deactivated"
         flash(f'User {user.email} has been {status} successfully.', 'success')
         
-    except Exception as e:
+    except Exception:
         db.session.rollback()
         flash('Failed to update user status. Please try again.', 'danger')
-        print(f"Toggle user status error: {e}")
+        logger.exception("Toggle user status failed")
     
     return redirect(url_for('admin.user_details', user_id=user_id))
 
@@ -232,21 +297,23 @@ def toggle_account_freeze(account_id):
     Args:
         account_id (int): Account ID to toggle
     """
-    account = Account.query.get_or_404(account_id)
+    account = db.get_or_404(Account, account_id)
     
     # Toggle the frozen status
     account.is_frozen = not account.is_frozen
     
     try:
         db.session.commit()
+        invalidate_admin_metrics()
+        invalidate_account_choices(account.user_id)
         
         status = "unfrozen" if not account.is_frozen else "frozen"
         flash(f'Account {account.account_number} has been {status} successfully.', 'success')
         
-    except Exception as e:
+    except Exception:
         db.session.rollback()
         flash('Failed to update account status. Please try again.', 'danger')
-        print(f"Toggle account freeze error: {e}")
+        logger.exception("Toggle account freeze failed")
     
     return redirect(url_for('admin.user_details', user_id=account.user_id))
 
@@ -262,72 +329,95 @@ def transactions():
     transaction_type = request.args.get('type', 'all')  # 'all', 'transfer', 'deposit', 'withdrawal'
     date_filter = request.args.get('date', '7')  # Days to look back (7, 30, 90, 'all')
     search_query = request.args.get('search', '').strip()  # Search by account number
-    page = request.args.get('page', 1, type=int)
+    after_id = request.args.get('after', type=int)  # Last transaction id of the previous page
     per_page = 50
     
-    # Build query
-    query = Transaction.query
+    # Filters shared by the page query and the totals
+    filters = []
     
     # Apply transaction type filter
     if transaction_type != 'all':
-        query = query.filter_by(transaction_type=transaction_type)
+        filters.append(Transaction.transaction_type == transaction_type)
     
     # Apply date filter
     if date_filter != 'all':
         days_back = int(date_filter)
-        cutoff_date = (datetime.utcnow() + timedelta(hours=5, minutes=30)) - timedelta(days=days_back)
-        query = query.filter(Transaction.timestamp >= cutoff_date)
+        cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_back)
+        filters.append(Transaction.timestamp >= cutoff_date)
     
     # Apply search filter (search by account number)
     if search_query:
-        # Find accounts matching the search
-        matching_accounts = Account.query.filter(
-            Account.account_number.like(f'%{search_query}%')
-        ).all()
-        account_ids = [acc.id for acc in matching_accounts]
+        # Match accounts inside the same statement (no id list round trip)
+        account_filter = account_number_prefix_filter(search_query)
         
-        if account_ids:
-            query = query.filter(
+        if account_filter is not None:
+            matching_account_ids = db.select(Account.id).where(account_filter)
+            filters.append(
                 db.or_(
-                    Transaction.from_account_id.in_(account_ids),
-                    Transaction.to_account_id.in_(account_ids)
+                    Transaction.from_account_id.in_(matching_account_ids),
+                    Transaction.to_account_id.in_(matching_account_ids)
                 )
             )
         else:
-            # No matching accounts, return empty result
-            query = query.filter(Transaction.id == -1)
+            # Can't match any account number, return empty result
+            filters.append(db.false())
+    
+    # Build query (the template shows both account numbers)
+    query = Transaction.query.options(
+        selectinload(Transaction.source_account),
+        selectinload(Transaction.destination_account)
+    ).filter(*filters)
+    
+    # Keyset pagination: continue strictly after the last row of the previous page,
+    # so each page costs the same regardless of depth and needs no COUNT(*)
+    if after_id is not None:
+        after_timestamp = db.select(Transaction.timestamp).where(
+            Transaction.id == after_id
+        ).scalar_subquery()
+        query = query.filter(
+            db.or_(
+                Transaction.timestamp < after_timestamp,
+                db.and_(Transaction.timestamp == after_timestamp, Transaction.id < after_id)
+            )
+        )
     
     # Order by most recent first
-    query = query.order_by(desc(Transaction.timestamp))
-    
-    # Paginate results
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-    transactions_list = pagination.items
-    
-    # Calculate total volume for filtered transactions
-    if date_filter != 'all':
-        days_back = int(date_filter)
-        cutoff_date = (datetime.utcnow() + timedelta(hours=5, minutes=30)) - timedelta(days=days_back)
-        volume_query = db.session.query(func.sum(Transaction.amount)).filter(
-            Transaction.timestamp >= cutoff_date
-        )
-    else:
-        volume_query = db.session.query(func.sum(Transaction.amount))
+    query = query.order_by(desc(Transaction.timestamp), desc(Transaction.id))
     
-    if transaction_type != 'all':
-        volume_query = volume_query.filter_by(transaction_type=transaction_type)
+    # Fetch one extra row to know whether an older page exists
+    transactions_list = query.limit(per_page + 1).all()
+    has_next = len(transactions_list) > per_page
+    transactions_list = transactions_list[:per_page]
+    next_after_id = transactions_list[-1].id if has_next else None
     
-    total_volume_cents = volume_query.scalar() or 0
+    # Count and volume for the same filters, search included (cached briefly)
+    totals_key = ADMIN_TRANSACTION_TOTALS_KEY.format(
+        transaction_type=transaction_type,
+        date_filter=date_filter,
+        search_query=search_query
+    )
+    totals = cache.get(totals_key)
+    if totals is None:
+        total_count, total_volume_cents = db.session.query(
+            func.count(Transaction.id),
+            func.sum(Transaction.amount)
+        ).filter(*filters).one()
+        totals = (total_count, total_volume_cents or 0)
+        cache.set(totals_key, totals)
+    
+    total_count, total_volume_cents = totals
     total_volume = total_volume_cents / 100.0
     
     return render_template(
         'admin/transactions.html',
         title='Transactions Monitor',
         transactions=transactions_list,
-        pagination=pagination,
+        is_first_page=after_id is None,
+        next_after_id=next_after_id,
         transaction_type=transaction_type,
         date_filter=date_filter,
         search_query=search_query,
+        total_count=total_count,
         total_volume=total_volume
     )
 
@@ -340,48 +430,32 @@ def statistics():
     Detailed statistics and analytics page
     """
     # Account type distribution
-    Current_count = Account.query.filter_by(account_type='Current').count()
-    savings_count = Account.query.filter_by(account_type='savings').count()
+    account_type_counts = dict(
+        db.session.query(Account.account_type, func.count(Account.id)).group_by(Account.account_type).all()
+    )
+    Current_count = account_type_counts.get('current', 0)
+    savings_count = account_type_counts.get('savings', 0)
     
     # Transaction type distribution (last 30 days)
-    thirty_days_ago = (datetime.utcnow() + timedelta(hours=5, minutes=30)) - timedelta(days=30)
-    
-    transfer_count = Transaction.query.filter(
-        Transaction.transaction_type == 'transfer',
-        Transaction.timestamp >= thirty_days_ago
-    ).count()
+    thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
     
-    deposit_count = Transaction.query.filter(
-        Transaction.transaction_type == 'deposit',
-        Transaction.timestamp >= thirty_days_ago
-    ).count()
-    
-    withdrawal_count = Transaction.query.filter(
-        Transaction.transaction_type == 'withdrawal',
-        Transaction.timestamp >= thirty_days_ago
-    ).count()
+    transaction_type_counts = dict(
+        db.session.query(Transaction.transaction_type, func.count(Transaction.id)).filter(
+            Transaction.timestamp >= thirty_days_ago
+        ).group_by(Transaction.transaction_type).all()
+    )
+    transfer_count = transaction_type_counts.get('transfer', 0)
+    deposit_count = transaction_type_counts.get('deposit', 0)
+    withdrawal_count = transaction_type_counts.get('withdrawal', 0)
     
     # Average account balance
-    avg_balance_cents = db.session.query(func.avg(Account.balance)).scalar() or 0
-    avg_balance = avg_balance_cents / 100.0
+    avg_balance = db.session.query(func.avg(Account.balance) / 100.0).scalar() or 0
     
     # Top 5 accounts by balance
     top_accounts = Account.query.order_by(desc(Account.balance)).limit(5).all()
     
-    # Users with most transactions
-    # This is complex, so we'll get top 5 users by number of accounts with transactions
-    users_with_transaction_counts = db.session.query(
-        User.id,
-        User.email,
-        User.full_name,
-        func.count(Transaction.id).label('transaction_count')
-    ).join(Account, User.id == Account.user_id).join(
-        Transaction,
-        db.or_(
-            Transaction.from_account_id == Account.id,
-            Transaction.to_account_id == Account.id
-        )
-    ).group_by(User.id).order_by(desc('transaction_count')).limit(5).all()
+    # Users with most transactions (cached, this scans the whole transactions table)
+    users_with_transaction_counts = get_top_users_by_transactions()
     
     return render_template(
         'admin/statistics.html',
@@ -397,6 +471,49 @@ def statistics():
     )
 
 
+def get_top_users_by_transactions(limit=5):
+    """
+    Rank users by the number of transactions touching any of their accounts
+    The result is cached for ADMIN_TOP_USERS_TIMEOUT seconds
+    
+    Args:
+        limit (int): Number of users to return
+    
+    Returns:
+        list: Dicts with id, email, full_name and transaction_count
+    """
+    top_users = cache.get(ADMIN_TOP_USERS_KEY)
+    if top_users is not None:
+        return top_users
+    
+    # One row per (account, transaction) side; UNION ALL of the two indexed
+    # foreign keys replaces an OR join condition the planner can't index
+    account_transactions = db.union_all(
+        db.select(
+            Transaction.from_account_id.label('account_id'),
+            Transaction.id.label('transaction_id')
+        ).where(Transaction.from_account_id.isnot(None)),
+        db.select(
+            Transaction.to_account_id.label('account_id'),
+            Transaction.id.label('transaction_id')
+        ).where(Transaction.to_account_id.isnot(None))
+    ).subquery()
+    
+    rows = db.session.query(
+        User.id,
+        User.email,
+        User.full_name,
+        func.count(account_transactions.c.transaction_id).label('transaction_count')
+    ).join(Account, User.id == Account.user_id).join(
+        account_transactions,
+        account_transactions.c.account_id == Account.id
+    ).group_by(User.id).order_by(desc('transaction_count')).limit(limit).all()
+    
+    top_users = [dict(row._mapping) for row in rows]
+    cache.set(ADMIN_TOP_USERS_KEY, top_users, timeout=ADMIN_TOP_USERS_TIMEOUT)
+    return top_users
+
+
 @bp.route('/search')
 @login_required
 @admin_required
@@ -410,6 +527,11 @@ def search():
         flash('Please enter a search query.', 'warning')
         return redirect(url_for('admin.dashboard'))
     
+    # Very short queries match most rows and can't be served by an index
+    if len(query) < 3:
+        flash('Please enter at least 3 characters to search.', 'warning')
+        return redirect(url_for('admin.dashboard'))
+    
     # Search users by email or name
     users_results = User.query.filter(
         db.or_(
@@ -418,15 +540,16 @@ def search():
         )
     ).limit(10).all()
     
-    # Search accounts by account number
-    accounts_results = Account.query.filter(
-        Account.account_number.like(f'%{query}%')
-    ).limit(10).all()
+    # Search accounts by account number prefix
+    account_filter = account_number_prefix_filter(query)
+    accounts_results = []
+    if account_filter is not None:
+        accounts_results = Account.query.filter(account_filter).limit(10).all()
     
     # Search transactions by description
     transactions_results = Transaction.query.filter(
         Transaction.description.ilike(f'%{query}%')
-    ).order_by(desc(Transaction.timestamp)).limit(10).all()
+    ).order_by(desc(Transaction.timestamp), desc(Transaction.id)).limit(10).all()
     
     return render_template(
         'admin/search_results.html',
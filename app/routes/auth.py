@@ -4,15 +4,37 @@ Handles user registration, login, and logout
 """
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, current_user
-from app import db
-from app.models import User, Admin, Account, generate_account_number
+from app import db, cache, limiter
+from app.caching import (
+    NO_EMAIL_KEY, NO_EMAIL_TIMEOUT, invalidate_admin_metrics, invalidate_user, shared_cache_enabled
+)
+from app.models import (
+    User, Admin, Account, generate_account_number, find_user_by_email, normalize_email, dummy_check_password
+)
 from app.forms import RegisterForm, LoginForm, AdminLoginForm
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create Blueprint
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
+def login_identity_key():
+    """
+    Rate limit key for the submitted login identity
+    Keys on the email or username so one account cannot be brute-forced
+    from many addresses
+    
+    Returns:
+        str: Endpoint-scoped, normalized email or username
+    """
+    identity = request.form.get('email') or request.form.get('username') or ''
+    return f'{request.endpoint}:{identity.strip().lower()}'
+
+
 @bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10 per hour', methods=['POST'])
 def register():
     """
     User registration route
@@ -30,7 +52,7 @@ def register():
     if form.validate_on_submit():
         # Create new user
         user = User(
-            email=form.email.data.lower().strip(),
+            email=form.email.data,
             full_name=form.email.data.split('@')[0],  # Use email username as name
             phone=None
         )
@@ -41,28 +63,32 @@ def register():
             db.session.add(user)
             db.session.flush()  # Get user.id without committing
             
-            # Create default checking account with ₹100 initial balance
+            # Create default current account with ₹100 initial balance
             account = Account(
                 user_id=user.id,
                 account_number=generate_account_number(),
-                account_type='Current',
+                account_type='current',
                 balance=10000  # ₹100.00 in cents
             )
             db.session.add(account)
             db.session.commit()
+            invalidate_admin_metrics()
+            cache.delete(NO_EMAIL_KEY.format(email=user.email))
             
             flash(f'Registration successful! Your account number is {account.account_number}. You can now login.', 'success')
             return redirect(url_for('auth.login'))
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
             flash('An error occurred during registration. Please try again.', 'danger')
-            print(f"Registration error: {e}")
+            logger.exception("Registration failed")
     
     return render_template('auth/register.html', form=form, title='Register')
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20 per minute', methods=['POST'])
+@limiter.limit('5 per 15 minutes', methods=['POST'], key_func=login_identity_key)
 def login():
     """
     User login route
@@ -78,14 +104,29 @@ def login():
     form = LoginForm()
     
     if form.validate_on_submit():
-        # Find user by email
-        user = User.query.filter_by(email=form.email.data.lower().strip()).first()
+        # Find user by email, skipping the query for recently unknown emails
+        no_email_key = NO_EMAIL_KEY.format(email=normalize_email(form.email.data))
+        use_cache = shared_cache_enabled()
+        user = None
+        if not (use_cache and cache.get(no_email_key)):
+            user = find_user_by_email(form.email.data)
+            if user is None and use_cache:
+                cache.set(no_email_key, True, timeout=NO_EMAIL_TIMEOUT)
+        
+        # Unknown emails still pay for a hash check so timing does not reveal them
+        if user is None:
+            dummy_check_password(form.password.data)
         
         # Validate credentials
         if user is None or not user.verify_password(form.password.data):
             flash('Invalid email or password. Please try again.', 'danger')
             return redirect(url_for('auth.login'))
         
+        # Persist a password hash upgraded during verification
+        if db.session.is_modified(user):
+            db.session.commit()
+            invalidate_user(user.get_id())
+        
         # Check if account is active
         if not user.is_active:
             flash('Your account has been deactivated. Please contact support.', 'warning')
@@ -105,6 +146,8 @@ def login():
 
 
 @bp.route('/admin-login', methods=['GET', 'POST'])
+@limiter.limit('20 per minute', methods=['POST'])
+@limiter.limit('5 per 15 minutes', methods=['POST'], key_func=login_identity_key)
 def admin_login():
     """
     Admin login route
@@ -123,11 +166,20 @@ def admin_login():
         # Find admin by username
         admin = Admin.query.filter_by(username=form.username.data.strip()).first()
         
+        # Unknown usernames still pay for a hash check so timing does not reveal them
+        if admin is None:
+            dummy_check_password(form.password.data)
+        
         # Validate credentials
         if admin is None or not admin.verify_password(form.password.data):
             flash('Invalid username or password. Please try again.', 'danger')
             return redirect(url_for('auth.admin_login'))
         
+        # Persist a password hash upgraded during verification
+        if db.session.is_modified(admin):
+            db.session.commit()
+            invalidate_user(admin.get_id())
+        
         # Log in admin
         login_user(admin, remember=form.remember.data)
         flash(f'Welcome, Admin {admin.username}!', 'success')
@@ -2,14 +2,26 @@
 Banking Management System - User Routes
 Handles user dashboard, accounts, transfers, and statements
 """
-from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, make_response
+from flask import Blueprint, render_template, redirect, url_for, flash, request, Response, stream_with_context
 from flask_login import login_required, current_user
-from app import db
-from app.models import User, Admin, Account, Transaction
+from app import db, cache
+from app.caching import (
+    ACCOUNT_CHOICES_KEY, ACCOUNT_CHOICES_TIMEOUT,
+    invalidate_admin_metrics, invalidate_account_choices, invalidate_user, shared_cache_enabled
+)
+from app.models import (
+    User, Admin, Account, Transaction, IST, to_ist, find_account_by_number, debit_account, credit_account,
+    transfer_funds
+)
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import selectinload
 from app.forms import TransferForm, CreateAccountForm, ChangePasswordForm, DepositForm, WithdrawForm
-from datetime import datetime, timedelta
+from datetime import datetime
 import csv
 from io import StringIO
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create Blueprint
 bp = Blueprint('user', __name__, url_prefix='/user')
@@ -28,10 +40,77 @@ def check_account_ownership(account_id):
     Raises:
         404: If account doesn't exist or doesn't belong to user
     """
-    account = Account.query.get_or_404(account_id)
-    if account.user_id != current_user.id:
-        abort(403)  # Forbidden
-    return account
+    # Ownership is part of the WHERE clause, so other users' accounts are never loaded
+    return db.one_or_404(
+        select(Account).where(Account.id == account_id, Account.user_id == current_user.id)
+    )
+
+
+def get_account_choices():
+    """
+    Dropdown choices for the current user's active accounts, cached until they change
+    
+    Returns:
+        tuple: (choices, accounts_by_id) - choices holds (account_id, label) lists under
+            'plain' and 'with_balance'; accounts_by_id maps id to Account when the rows
+            were loaded in this request, or is None when the labels came from the cache
+    """
+    cache_key = ACCOUNT_CHOICES_KEY.format(user_id=current_user.id)
+    choices = cache.get(cache_key) if shared_cache_enabled() else None
+    accounts_by_id = None
+    
+    if choices is None:
+        user_accounts = Account.query.filter_by(
+            user_id=current_user.id,
+            is_frozen=False
+        ).all()
+        choices = {
+            'plain': [(acc.id, f'{acc.account_number} - {acc.account_type.title()}')
+                      for acc in user_accounts],
+            'with_balance': [(acc.id, f'{acc.account_number} - {acc.account_type.title()} (₹{acc.balance_dollars:.2f})')
+                             for acc in user_accounts]
+        }
+        accounts_by_id = {acc.id: acc for acc in user_accounts}
+        if shared_cache_enabled():
+            cache.set(cache_key, choices, timeout=ACCOUNT_CHOICES_TIMEOUT)
+    
+    return choices, accounts_by_id
+
+
+def get_active_account(account_id):
+    """
+    Load one of the current user's active accounts by ID
+    
+    Args:
+        account_id (int): Account ID submitted in a form
+        
+    Returns:
+        Account: The account, or None if it is not the user's or is frozen
+    """
+    return db.session.execute(
+        select(Account).where(
+            Account.id == account_id,
+            Account.user_id == current_user.id,
+            Account.is_frozen.is_(False)
+        )
+    ).scalar_one_or_none()
+
+
+def resolve_active_account(account_id, accounts_by_id):
+    """
+    Resolve a submitted account ID to one of the current user's active accounts
+    Reuses the rows loaded for the dropdown and only queries when the labels were cached
+    
+    Args:
+        account_id (int): Account ID submitted in a form
+        accounts_by_id (dict): Accounts returned by get_account_choices, or None
+        
+    Returns:
+        Account: The account, or None if it is not the user's or is frozen
+    """
+    if accounts_by_id is not None:
+        return accounts_by_id.get(account_id)
+    return get_active_account(account_id)
 
 
 @bp.route('/dashboard')
@@ -45,23 +124,19 @@ def dashboard():
         return redirect(url_for('admin.dashboard'))
     
     # Get all user accounts
-    accounts = current_user.accounts.all()
-    
-    # Get recent transactions across all accounts (last 10)
-    transactions_map = {}
-    for account in accounts:
-        transactions = account.get_all_transactions()
-        for tx in transactions:
-            transactions_map[tx.id] = tx
-            
-    # Convert back to a list
-    recent_transactions = list(transactions_map.values())
+    accounts = current_user.accounts
     
-    # Sort by timestamp and limit to 10
-    recent_transactions = sorted(recent_transactions, key=lambda x: x.timestamp, reverse=True)[:10]
+    # Get recent transactions across all accounts (last 10) in one query
+    account_ids = [account.id for account in accounts]
+    recent_transactions = Transaction.query.filter(
+        db.or_(
+            Transaction.from_account_id.in_(account_ids),
+            Transaction.to_account_id.in_(account_ids)
+        )
+    ).order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(10).all()
     
-    # Calculate total balance
-    total_balance = current_user.get_total_balance()
+    # Calculate total balance from the accounts already loaded above
+    total_balance = sum(account.balance for account in accounts) / 100.0
     
     return render_template(
         'user/dashboard.html',
@@ -112,94 +187,79 @@ def transfer():
         flash('Admins cannot perform transfers.', 'warning')
         return redirect(url_for('admin.dashboard'))
     
-    form = TransferForm()
-    
     # Populate account choices with user's active accounts
-    user_accounts = Account.query.filter_by(
-        user_id=current_user.id,
-        is_frozen=False
-    ).all()
+    choices, accounts_by_id = get_account_choices()
     
-    if not user_accounts:
+    if not choices['with_balance']:
         flash('You need at least one active account to make transfers.', 'warning')
         return redirect(url_for('user.dashboard'))
     
-    form.from_account.choices = [(acc.id, f'{acc.account_number} - {acc.account_type.title()} (₹{acc.get_balance():.2f})') 
-                                   for acc in user_accounts]
+    form = TransferForm()
+    form.from_account.choices = choices['with_balance']
     
     if form.validate_on_submit():
+        # Get source account (only the user's active accounts can resolve)
+        from_account = resolve_active_account(form.from_account.data, accounts_by_id)
+        
+        if from_account is None:
+            flash('Invalid source account.', 'danger')
+            return redirect(url_for('user.transfer'))
+        
+        # Get destination account (already looked up by the form validator)
+        to_account = find_account_by_number(form.to_account_id.data)
+        
+        if not to_account:
+            flash('Destination account not found.', 'danger')
+            return redirect(url_for('user.transfer'))
+        
+        # Check if destination account is frozen
+        if to_account.is_frozen:
+            flash('Destination account is frozen and cannot receive transfers.', 'danger')
+            return redirect(url_for('user.transfer'))
+        
+        # Prevent self-transfer
+        if from_account.id == to_account.id:
+            flash('Cannot transfer to the same account.', 'warning')
+            return redirect(url_for('user.transfer'))
+        
+        # Convert amount to cents
+        amount_cents = int(form.amount.data * 100)
+        
+        # Perform atomic transaction: conditional debit, credit, and record
         try:
-            # Get source account
-            from_account = Account.query.get(form.from_account.data)
-            
-            # Verify ownership (security check)
-            if from_account.user_id != current_user.id:
-                flash('Invalid source account.', 'danger')
-                return redirect(url_for('user.transfer'))
-            
-            # Check if account is frozen
-            if from_account.is_frozen:
-                flash('Your account is frozen. Please contact support.', 'danger')
-                return redirect(url_for('user.dashboard'))
-            
-            # Get destination account
-            to_account = Account.query.filter_by(account_number=form.to_account_id.data).first()
+            failed_step = transfer_funds(from_account.id, to_account.id, amount_cents)
             
-            if not to_account:
-                flash('Destination account not found.', 'danger')
+            if failed_step == 'debit':
+                db.session.rollback()
+                flash(f'Insufficient balance. Available: ₹{from_account.get_balance():.2f}', 'danger')
                 return redirect(url_for('user.transfer'))
             
-            # Check if destination account is frozen
-            if to_account.is_frozen:
+            if failed_step == 'credit':
+                db.session.rollback()
                 flash('Destination account is frozen and cannot receive transfers.', 'danger')
                 return redirect(url_for('user.transfer'))
             
-            # Prevent self-transfer
-            if from_account.id == to_account.id:
-                flash('Cannot transfer to the same account.', 'warning')
-                return redirect(url_for('user.transfer'))
+            # Create transaction record
+            transaction = Transaction(
+                from_account_id=from_account.id,
+                to_account_id=to_account.id,
+                amount=amount_cents,
+                transaction_type='transfer',
+                description=form.description.data or f'Transfer to {to_account.account_number}'
+            )
             
-            # Convert amount to cents
-            amount_cents = int(form.amount.data * 100)
+            db.session.add(transaction)
+            db.session.commit()
+            invalidate_admin_metrics()
+            invalidate_account_choices(from_account.user_id, to_account.user_id)
             
-            # Check sufficient balance
-            if from_account.balance < amount_cents:
-                flash(f'Insufficient balance. Available: ₹{from_account.get_balance():.2f}', 'danger')
-                return redirect(url_for('user.transfer'))
+            flash(f'Successfully transferred ₹{form.amount.data:.2f} to account {to_account.account_number}!', 'success')
+            return redirect(url_for('user.dashboard'))
             
-            # Perform atomic transaction
-            try:
-                # Deduct from source account
-                from_account.balance -= amount_cents
-                
-                # Add to destination account
-                to_account.balance += amount_cents
-                
-                # Create transaction record
-                transaction = Transaction(
-                    from_account_id=from_account.id,
-                    to_account_id=to_account.id,
-                    amount=amount_cents,
-                    transaction_type='transfer',
-                    description=form.description.data or f'Transfer to {to_account.account_number}',
-                    timestamp=datetime.utcnow() + timedelta(hours=5, minutes=30)
-                )
-                
-                db.session.add(transaction)
-                db.session.commit()
-                
-                flash(f'Successfully transferred ₹{form.amount.data:.2f} to account {to_account.account_number}!', 'success')
-                return redirect(url_for('user.dashboard'))
-                
-            except Exception as e:
-                db.session.rollback()
-                flash('Transfer failed. Please try again.', 'danger')
-                print(f"Transfer error: {e}")
-                return redirect(url_for('user.transfer'))
-                
-        except Exception as e:
-            flash('An error occurred. Please try again.', 'danger')
-            print(f"Transfer validation error: {e}")
+        except Exception:
+            db.session.rollback()
+            flash('Transfer failed. Please try again.', 'danger')
+            logger.exception("Transfer failed")
             return redirect(url_for('user.transfer'))
     
     return render_template('user/transfer.html', title='Transfer Money', form=form)
@@ -225,59 +285,92 @@ def statement(account_id):
     # Verify ownership
     account = check_account_ownership(account_id)
     
-    # Get all transactions
-    transactions = account.get_all_transactions()
-    
-    # Create CSV in memory
-    output = StringIO()
-    output.write('\ufeff')
-    writer = csv.writer(output)
-    
-    # Write header
-    writer.writerow([
-        'Date',
-        'Type',
-        'From Account',
-        'To Account',
-        'Amount',
-        'Balance After',
-        'Description'
-    ])
-    
-    # Calculate running balance
-    running_balance = account.balance
-    
-    # Write transactions (most recent first, so we need to reverse for balance calculation)
-    for transaction in reversed(transactions):
-        # Determine if money came in or went out
-        if transaction.to_account_id == account.id:
-            # Money received
-            amount_str = f'+₹{transaction.get_amount():.2f}'
-            from_acc = transaction.source_account.account_number if transaction.source_account else 'External'
-            to_acc = account.account_number
-        elif transaction.from_account_id == account.id:
-            # Money sent
-            amount_str = f'-₹{transaction.get_amount():.2f}'
-            from_acc = account.account_number
-            to_acc = transaction.destination_account.account_number if transaction.destination_account else 'External'
-        else:
-            continue  # Skip if transaction doesn't involve this account
+    # Signed amount from this account's point of view; the running balance after
+    # each row is the current balance minus everything that happened later
+    signed_amount = case(
+        (Transaction.to_account_id == account.id, Transaction.amount),
+        else_=-Transaction.amount
+    )
+    balance_after = (
+        account.balance
+        - func.sum(signed_amount).over()
+        + func.sum(signed_amount).over(order_by=(Transaction.timestamp, Transaction.id))
+    ).label('balance_after')
+    
+    # Stream transactions oldest first straight from the database
+    transactions = db.session.query(Transaction, balance_after).options(
+        selectinload(Transaction.source_account),
+        selectinload(Transaction.destination_account)
+    ).filter(
+        db.or_(
+            Transaction.from_account_id == account.id,
+            Transaction.to_account_id == account.id
+        )
+    ).order_by(
+        Transaction.timestamp.asc(),
+        Transaction.id.asc()
+    ).execution_options(stream_results=True).yield_per(500)
+    
+    def generate():
+        """
+        Yield the CSV statement one row at a time
+        
+        Returns:
+            Generator of CSV text chunks
+        """
+        output = StringIO()
+        writer = csv.writer(output)
+        
+        def flush():
+            chunk = output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            return chunk
         
+        yield '\ufeff'
+        
+        # Write header
         writer.writerow([
-            transaction.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            transaction.transaction_type.title(),
-            from_acc,
-            to_acc,
-            amount_str,
-            f'₹{running_balance / 100:.2f}',
-            transaction.description or 'N/A'
+            'Date',
+            'Type',
+            'From Account',
+            'To Account',
+            'Amount',
+            'Balance After',
+            'Description'
         ])
-    
-    # Create response
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv'
-    response.headers['Content-Disposition'] = f'attachment; filename=statement_{account.account_number}_{datetime.now().strftime("%Y%m%d")}.csv'
+        yield flush()
+        
+        for transaction, running_balance in transactions:
+            # Determine if money came in or went out
+            if transaction.to_account_id == account.id:
+                # Money received
+                amount_str = f'+₹{transaction.get_amount():.2f}'
+                from_acc = transaction.source_account.account_number if transaction.source_account else 'External'
+                to_acc = account.account_number
+            elif transaction.from_account_id == account.id:
+                # Money sent
+                amount_str = f'-₹{transaction.get_amount():.2f}'
+                from_acc = account.account_number
+                to_acc = transaction.destination_account.account_number if transaction.destination_account else 'External'
+            else:
+                continue  # Skip if transaction doesn't involve this account
+            
+            writer.writerow([
+                to_ist(transaction.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+                transaction.transaction_type.title(),
+                from_acc,
+                to_acc,
+                amount_str,
+                f'₹{running_balance / 100:.2f}',
+                transaction.description or 'N/A'
+            ])
+            yield flush()
+    
+    # Create streaming response
+    filename = f'statement_{account.account_number}_{datetime.now(IST).strftime("%Y%m%d")}.csv'
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
     
     return response
 
@@ -314,14 +407,16 @@ def create_account():
             
             db.session.add(new_account)
             db.session.commit()
+            invalidate_admin_metrics()
+            invalidate_account_choices(current_user.id)
             
             flash(f'New {form.account_type.data} account created successfully! Account number: {new_account.account_number}', 'success')
             return redirect(url_for('user.dashboard'))
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
             flash('Failed to create account. Please try again.', 'danger')
-            print(f"Account creation error: {e}")
+            logger.exception("Account creation failed")
     
     return render_template('user/create_account.html', title='Create Account', form=form)
 
@@ -339,27 +434,22 @@ def deposit():
         flash('Admins cannot deposit money.', 'warning')
         return redirect(url_for('admin.dashboard'))
     
-    form = DepositForm()
-    
     # Populate account choices
-    user_accounts = Account.query.filter_by(
-        user_id=current_user.id,
-        is_frozen=False
-    ).all()
+    choices, accounts_by_id = get_account_choices()
     
-    if not user_accounts:
+    if not choices['plain']:
         flash('You need at least one active account to make deposits.', 'warning')
         return redirect(url_for('user.dashboard'))
     
-    form.account.choices = [(acc.id, f'{acc.account_number} - {acc.account_type.title()}') 
-                            for acc in user_accounts]
+    form = DepositForm()
+    form.account.choices = choices['plain']
     
     if form.validate_on_submit():
         try:
-            account = Account.query.get(form.account.data)
+            # Get account (only the user's active accounts can resolve)
+            account = resolve_active_account(form.account.data, accounts_by_id)
             
-            # Verify ownership
-            if account.user_id != current_user.id:
+            if account is None:
                 flash('Invalid account.', 'danger')
                 return redirect(url_for('user.deposit'))
             
@@ -367,27 +457,31 @@ def deposit():
             amount_cents = int(form.amount.data * 100)
             
             # Perform deposit
-            account.balance += amount_cents
+            if not credit_account(account.id, amount_cents):
+                db.session.rollback()
+                flash('Your account is frozen. Please contact support.', 'danger')
+                return redirect(url_for('user.dashboard'))
             
             # Create transaction record
             transaction = Transaction(
                 to_account_id=account.id,
                 amount=amount_cents,
                 transaction_type='deposit',
-                description=form.description.data or 'Cash deposit',
-                timestamp=datetime.utcnow() + timedelta(hours=5, minutes=30)
+                description=form.description.data or 'Cash deposit'
             )
             
             db.session.add(transaction)
             db.session.commit()
+            invalidate_admin_metrics()
+            invalidate_account_choices(current_user.id)
             
             flash(f'Successfully deposited ₹{form.amount.data:.2f} into account {account.account_number}!', 'success')
             return redirect(url_for('user.dashboard'))
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
             flash('Deposit failed. Please try again.', 'danger')
-            print(f"Deposit error: {e}")
+            logger.exception("Deposit failed")
     
     return render_template('user/deposit.html', title='Deposit Money', form=form)
 
@@ -405,60 +499,54 @@ def withdraw():
         flash('Admins cannot withdraw money.', 'warning')
         return redirect(url_for('admin.dashboard'))
     
-    form = WithdrawForm()
-    
     # Populate account choices
-    user_accounts = Account.query.filter_by(
-        user_id=current_user.id,
-        is_frozen=False
-    ).all()
+    choices, accounts_by_id = get_account_choices()
     
-    if not user_accounts:
+    if not choices['with_balance']:
         flash('You need at least one active account to make withdrawals.', 'warning')
         return redirect(url_for('user.dashboard'))
     
-    form.account.choices = [(acc.id, f'{acc.account_number} - {acc.account_type.title()} (₹{acc.get_balance():.2f})') 
-                            for acc in user_accounts]
+    form = WithdrawForm()
+    form.account.choices = choices['with_balance']
     
     if form.validate_on_submit():
         try:
-            account = Account.query.get(form.account.data)
+            # Get account (only the user's active accounts can resolve)
+            account = resolve_active_account(form.account.data, accounts_by_id)
             
-            # Verify ownership
-            if account.user_id != current_user.id:
+            if account is None:
                 flash('Invalid account.', 'danger')
                 return redirect(url_for('user.withdraw'))
             
             # Convert amount to cents
             amount_cents = int(form.amount.data * 100)
             
-            # Check sufficient balance
-            if account.balance < amount_cents:
+            # Perform withdrawal only if the balance covers it
+            if not debit_account(account.id, amount_cents):
+                db.session.rollback()
                 flash(f'Insufficient balance. Available: ₹{account.get_balance():.2f}', 'danger')
                 return redirect(url_for('user.withdraw'))
             
-            # Perform withdrawal
-            account.balance -= amount_cents
-            
             # Create transaction record
             transaction = Transaction(
                 from_account_id=account.id,
                 amount=amount_cents,
                 transaction_type='withdrawal',
-                description=form.description.data or 'Cash withdrawal',
-                timestamp=datetime.utcnow() + timedelta(hours=5, minutes=30)
+                description=form.description.data or 'Cash withdrawal'
             )
             
             db.session.add(transaction)
             db.session.commit()
+            invalidate_admin_metrics()
+            invalidate_account_choices(current_user.id)
             
             flash(f'Successfully withdrew ₹{form.amount.data:.2f} from account {account.account_number}!', 'success')
             return redirect(url_for('user.dashboard'))
             
-        except Exception as e:
+        except Exception:
             db.session.rollback()
             flash('Withdrawal failed. Please try again.', 'danger')
-            print(f"Withdrawal error: {e}")
+            logger.exception("Withdrawal failed")
     
     return render_template('user/withdraw.html', title='Withdraw Money', form=form)
 
@@ -486,6 +574,7 @@ def change_password():
         # Update password
         current_user.set_password(form.new_password.data)
         db.session.commit()
+        invalidate_user(current_user.get_id())
         
         flash('Password changed successfully!', 'success')
         return redirect(url_for('user.dashboard'))
@@ -1,26 +1,78 @@
 import pytest
-from app import create_app, db, Config
-from app.models import User, Account, Admin
+import re
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+from werkzeug.security import generate_password_hash
+from app import create_app, db, cache, limiter, Config
+from app.models import User, Account, Admin, Transaction, secure_equals
 
 class TestConfig(Config):
     """Test configuration that uses in-memory database and disables CSRF"""
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # One shared in-memory connection, so the schema lives for the whole module
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        **Config.SQLALCHEMY_ENGINE_OPTIONS,
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False}
+    }
     WTF_CSRF_ENABLED = False  # Disable CSRF forms protection for testing
+    CACHE_SHARED = True  # Single process, so the in-process cache is shared
 
-@pytest.fixture
-def client():
-    """Fixture to configure the app and database for tests"""
-    app = create_app(TestConfig)
+@pytest.fixture(scope='module')
+def app():
+    """Fixture to create the app and its schema once per test module"""
+    app = create_app(TestConfig)  # Runs db.create_all()
+    
+    with app.app_context():
+        # Let pysqlite's SAVEPOINTs nest inside our own BEGIN
+        raw_connection = db.engine.raw_connection()
+        raw_connection.driver_connection.isolation_level = None
+        raw_connection.close()
+        event.listen(db.engine, 'begin', lambda conn: conn.exec_driver_sql('BEGIN'))
     
-    # Create a test client
-    with app.test_client() as client:
-        # Establish an application context
-        with app.app_context():
-            db.create_all()  # Create tables
-            yield client     # Yield the client for the test
-            db.session.remove()
-            db.drop_all()    # Clean up after test
+    yield app
+
+@pytest.fixture
+def client(app):
+    """Fixture to run each test inside a transaction that is rolled back afterwards"""
+    with app.app_context():
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        
+        # Route every session to this connection; commits release savepoints only
+        db.engines[None] = connection
+        db.session.configure(join_transaction_mode='create_savepoint')
+        
+        # Create a test client
+        with app.test_client() as client:
+            try:
+                yield client
+            finally:
+                db.session.remove()
+                transaction.rollback()
+                connection.close()
+                db.engines[None] = connection.engine
+                cache.clear()
+                limiter.reset()
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement issued against the engine inside the block"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
 
 def test_register_and_login_flow(client):
     """Test that a user can register and then log in"""
@@ -40,8 +92,8 @@ def test_register_and_login_flow(client):
         user = User.query.filter_by(email='newuser@test.com').first()
         assert user is not None
         # Verify default account creation
-        assert user.accounts.count() == 1
-        assert user.accounts.first().balance == 10000  # Default 100.00
+        assert len(user.accounts) == 1
+        assert user.accounts[0].balance == 10000  # Default 100.00
 
     # 2. Login with the new credentials
     login_response = client.post('/auth/login', data={
@@ -58,33 +110,27 @@ def test_create_transfer_and_balance_update(client):
     """Test creating a transfer between accounts and verifying balances"""
     with client.application.app_context():
         # Setup: Create two users with accounts
-        # User 1 (Sender)
+        # User 1 (Sender), User 2 (Receiver)
         u1 = User(email='sender@test.com', full_name='Sender')
         u1.set_password('pass')
-        db.session.add(u1)
-        db.session.flush() # Flush to get ID
+        u2 = User(email='receiver@test.com', full_name='Receiver')
+        u2.set_password('pass')
+        db.session.add_all([u1, u2])
+        db.session.flush() # Flush to get IDs
         
         acc1 = Account(
             user_id=u1.id, 
             account_number='1000000001', 
-            account_type='checking', 
+            account_type='current', 
             balance=5000 # ₹50.00
         )
-        db.session.add(acc1)
-        
-        # User 2 (Receiver)
-        u2 = User(email='receiver@test.com', full_name='Receiver')
-        u2.set_password('pass')
-        db.session.add(u2)
-        db.session.flush()
-        
         acc2 = Account(
             user_id=u2.id, 
             account_number='2000000002', 
             account_type='savings', 
             balance=1000 # ₹10.00
         )
-        db.session.add(acc2)
+        db.session.add_all([acc1, acc2])
         db.session.commit()
 
         # Save IDs for later verification
@@ -162,4 +208,358 @@ def test_admin_access_control(client):
     resp_admin = client.get('/admin/dashboard')
     # Should succeed
     assert resp_admin.status_code == 200
-    assert b'Admin Dashboard' in resp_admin.data
\ No newline at end of file
+    assert b'Admin Dashboard' in resp_admin.data
+
+def test_total_balance_uses_single_query(client):
+    """Test that a user's total balance is summed in one SQL statement"""
+    with client.application.app_context():
+        user = User(email='many@test.com', full_name='Many Accounts')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.flush()
+
+        db.session.add_all([
+            Account(
+                user_id=user.id,
+                account_number=f'300000000{i}',
+                account_type='savings',
+                balance=1000 * (i + 1)
+            )
+            for i in range(5)
+        ])
+        db.session.commit()
+        db.session.refresh(user)
+
+        with count_queries() as statements:
+            total = user.get_total_balance()
+
+        assert total == 150.0  # 1000 + 2000 + ... + 5000 cents
+        assert len(statements) == 1
+
+def test_no_plain_equality_on_secrets():
+    """Test that password hashes are never compared with == or !="""
+    pattern = re.compile(r'password(_hash)?\s*[!=]=')
+    app_dir = Path(__file__).resolve().parent.parent / 'app'
+    offenders = [
+        f'{path.name}:{lineno}'
+        for path in app_dir.rglob('*.py')
+        for lineno, line in enumerate(path.read_text(encoding='utf-8').splitlines(), 1)
+        if pattern.search(line)
+    ]
+    assert offenders == []
+    assert secure_equals('token', 'token')
+    assert not secure_equals('token', 'tokem')
+
+def test_admin_transactions_keyset_pagination(client):
+    """Test that paging through transactions returns every row exactly once"""
+    with client.application.app_context():
+        user = User(email='busy@test.com', full_name='Busy')
+        user.set_password('pass')
+        admin = Admin(username='pager_admin', email='pager@test.com')
+        admin.set_password('adminpass')
+        db.session.add_all([user, admin])
+        db.session.flush()
+
+        account = Account(user_id=user.id, account_number='4000000004', account_type='savings', balance=0)
+        db.session.add(account)
+        db.session.flush()
+
+        # One shared timestamp, so ordering and the (timestamp, id) cursor rely on the id tie-breaker
+        same_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        db.session.add_all([
+            Transaction(to_account_id=account.id, amount=100, transaction_type='deposit', timestamp=same_time)
+            for _ in range(60)
+        ])
+        db.session.commit()
+
+    client.post('/auth/admin-login', data={
+        'username': 'pager_admin',
+        'password': 'adminpass'
+    }, follow_redirects=True)
+
+    id_pattern = re.compile(rb'badge bg-secondary">#(\d+)<')
+    first_page = client.get('/admin/transactions?date=all')
+    first_ids = [int(i) for i in id_pattern.findall(first_page.data)]
+    assert len(first_ids) == 50
+    assert first_ids == sorted(first_ids, reverse=True)
+
+    second_page = client.get(f'/admin/transactions?date=all&after={first_ids[-1]}')
+    second_ids = [int(i) for i in id_pattern.findall(second_page.data)]
+    assert len(second_ids) == 10
+    assert set(first_ids).isdisjoint(second_ids)
+    assert b'Older' not in second_page.data
+
+    # Totals follow the account-number search
+    count_pattern = re.compile(rb'<h3 class="fw-bold mb-1">(\d+)</h3>')
+    assert count_pattern.findall(first_page.data) == [b'60']
+    no_match = client.get('/admin/transactions?date=all&search=9999')
+    assert count_pattern.findall(no_match.data) == [b'0']
+    prefix_match = client.get('/admin/transactions?date=all&search=40000')
+    assert count_pattern.findall(prefix_match.data) == [b'60']
+    suffix_only = client.get('/admin/transactions?date=all&search=0004')
+    assert count_pattern.findall(suffix_only.data) == [b'0']
+
+def test_email_is_case_insensitive(client):
+    """Test that emails are stored lowercase and duplicates differing in case are rejected"""
+    client.post('/auth/register', data={
+        'email': 'Mixed.Case@Test.com',
+        'password': 'password123',
+        'confirm': 'password123'
+    }, follow_redirects=True)
+
+    with client.application.app_context():
+        user = User.query.filter_by(email='mixed.case@test.com').first()
+        assert user is not None
+
+    duplicate = client.post('/auth/register', data={
+        'email': 'mixed.case@TEST.com',
+        'password': 'password123',
+        'confirm': 'password123'
+    }, follow_redirects=True)
+    assert b'Email already registered' in duplicate.data
+
+def test_legacy_password_hash_upgraded_on_login(client):
+    """Test that a legacy pbkdf2 hash still logs in and is rehashed with Argon2id"""
+    with client.application.app_context():
+        user = User(
+            email='legacy@test.com',
+            full_name='Legacy',
+            password_hash=generate_password_hash('oldpass', method='pbkdf2:sha256')
+        )
+        db.session.add(user)
+        db.session.commit()
+
+    response = client.post('/auth/login', data={
+        'email': 'legacy@test.com',
+        'password': 'oldpass'
+    }, follow_redirects=True)
+    assert b'Welcome back' in response.data
+
+    with client.application.app_context():
+        user = User.query.filter_by(email='legacy@test.com').first()
+        assert user.password_hash.startswith('$argon2id$')
+        assert user.verify_password('oldpass')
+
+def test_statement_running_balance(client):
+    """Test that the CSV statement shows the balance after each transaction"""
+    with client.application.app_context():
+        user = User(email='statement@test.com', full_name='Statement')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.flush()
+
+        account = Account(user_id=user.id, account_number='4000000004', account_type='savings', balance=10000)
+        db.session.add(account)
+        db.session.commit()
+        account_id = account.id
+
+    client.post('/auth/login', data={'email': 'statement@test.com', 'password': 'pass'})
+    client.post('/user/deposit', data={'account': account_id, 'amount': 50.00})
+    client.post('/user/withdraw', data={'account': account_id, 'amount': 30.00})
+
+    response = client.get(f'/user/statement/{account_id}')
+    rows = response.get_data(as_text=True).lstrip('﻿').splitlines()[1:]
+
+    # Opening ₹100.00, +₹50.00, -₹30.00
+    assert [row.split(',')[5] for row in rows] == ['₹150.00', '₹120.00']
+
+def test_other_users_account_not_found(client):
+    """Test that account pages and statements of another user return 404"""
+    with client.application.app_context():
+        owner = User(email='owner@test.com', full_name='Owner')
+        owner.set_password('pass')
+        intruder = User(email='intruder@test.com', full_name='Intruder')
+        intruder.set_password('pass')
+        db.session.add_all([owner, intruder])
+        db.session.flush()
+
+        account = Account(user_id=owner.id, account_number='4000000005', account_type='savings', balance=10000)
+        db.session.add(account)
+        db.session.commit()
+        account_id = account.id
+
+    client.post('/auth/login', data={'email': 'intruder@test.com', 'password': 'pass'})
+
+    details = client.get(f'/user/account/{account_id}')
+    assert details.status_code == 404
+    assert b'Page Not Found' in details.data
+
+    statement = client.get(f'/user/statement/{account_id}')
+    assert statement.status_code == 404
+    assert b'4000000005' not in statement.data
+
+def test_user_loader_is_cached(client):
+    """Test that the logged-in user is served from cache until it changes"""
+    with client.application.app_context():
+        user = User(email='cached@test.com', full_name='Cached')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.commit()
+
+    client.post('/auth/login', data={'email': 'cached@test.com', 'password': 'pass'})
+
+    def users_selects_for(path):
+        # Drop the loaded user and identity map so the request goes through load_user
+        db.session.remove()
+        g.pop('_login_user', None)
+        with count_queries() as statements:
+            client.get(path)
+        return [s for s in statements if 'FROM users' in s]
+
+    assert len(users_selects_for('/user/change-password')) == 1
+    assert not users_selects_for('/user/change-password')
+
+    # The cached snapshot never carries the password hash
+    with client.application.app_context():
+        user_id = User.query.filter_by(email='cached@test.com').first().get_id()
+    assert 'password_hash' not in cache.get(f'user:{user_id}')
+
+    # Changing the password drops the cached row so the new hash is used
+    response = client.post('/user/change-password', data={
+        'Current_password': 'pass',
+        'new_password': 'newpass123',
+        'confirm_new_password': 'newpass123'
+    }, follow_redirects=True)
+    assert b'Password changed successfully' in response.data
+
+    with client.application.app_context():
+        user = User.query.filter_by(email='cached@test.com').first()
+        assert user.verify_password('newpass123')
+
+def test_login_rate_limited_per_email(client):
+    """Test that repeated login attempts for one email are rejected with 429"""
+    for _ in range(5):
+        response = client.post('/auth/login', data={'email': 'victim@test.com', 'password': 'wrong'})
+        assert response.status_code == 302
+
+    response = client.post('/auth/login', data={'email': 'Victim@test.com', 'password': 'wrong'})
+    assert response.status_code == 429
+
+    # Other accounts are unaffected
+    response = client.post('/auth/login', data={'email': 'other@test.com', 'password': 'wrong'})
+    assert response.status_code == 302
+
+def test_unknown_email_cached_until_registration(client):
+    """Test that a failed lookup is cached and cleared when the email registers"""
+    client.post('/auth/login', data={'email': 'later@test.com', 'password': 'password123'})
+
+    with count_queries() as statements:
+        client.post('/auth/login', data={'email': 'later@test.com', 'password': 'password123'})
+    assert not [s for s in statements if 'FROM users' in s]
+
+    client.post('/auth/register', data={
+        'email': 'later@test.com',
+        'password': 'password123',
+        'confirm': 'password123'
+    })
+    response = client.post('/auth/login', data={
+        'email': 'later@test.com',
+        'password': 'password123'
+    }, follow_redirects=True)
+    assert b'Welcome back' in response.data
+
+def test_account_pages_issue_constant_queries(client):
+    """Test that dashboard, account and statement queries do not grow with accounts or counterparties"""
+    with client.application.app_context():
+        user = User(email='busy@test.com', full_name='Busy')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.flush()
+
+        db.session.add_all([
+            Account(user_id=user.id, account_number=f'500000000{i}', account_type='savings', balance=10000)
+            for i in range(4)
+        ])
+        db.session.commit()
+        account_ids = [account.id for account in user.accounts]
+
+    client.post('/auth/login', data={'email': 'busy@test.com', 'password': 'pass'})
+    for account_id in account_ids:
+        client.post('/user/deposit', data={'account': account_id, 'amount': 5.00})
+    # One transfer to each other account, so the first account has several counterparties
+    for i in range(1, 4):
+        client.post('/user/transfer', data={
+            'from_account': account_ids[0],
+            'to_account_id': f'500000000{i}',
+            'amount': 1.00
+        })
+
+    def selects_for(path):
+        # Start from an empty identity map and no loaded user, as a fresh request would
+        db.session.remove()
+        g.pop('_login_user', None)
+        with count_queries() as statements:
+            client.get(path).get_data()
+        return [s for s in statements if s.startswith('SELECT')]
+
+    selects_for('/user/dashboard')  # Warm the user loader cache
+
+    # Accounts (also summed for the total), recent transactions
+    assert len(selects_for('/user/dashboard')) == 2
+    # Ownership check, transactions, one batched load per related account side
+    assert len(selects_for(f'/user/account/{account_ids[0]}')) <= 4
+    assert len(selects_for(f'/user/statement/{account_ids[0]}')) <= 4
+
+def test_account_choices_refresh_after_balance_change(client):
+    """Test that cached dropdown labels pick up a new balance after a deposit"""
+    with client.application.app_context():
+        user = User(email='choices@test.com', full_name='Choices')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.flush()
+
+        account = Account(user_id=user.id, account_number='6000000006', account_type='savings', balance=10000)
+        db.session.add(account)
+        db.session.commit()
+        account_id = account.id
+
+    client.post('/auth/login', data={'email': 'choices@test.com', 'password': 'pass'})
+    assert '(₹100.00)' in client.get('/user/withdraw').get_data(as_text=True)
+
+    # Served from cache: no account query on the form page
+    with count_queries() as statements:
+        client.get('/user/withdraw')
+    assert not [s for s in statements if 'FROM accounts' in s]
+
+    client.post('/user/deposit', data={'account': account_id, 'amount': 50.00})
+    assert '(₹150.00)' in client.get('/user/withdraw').get_data(as_text=True)
+
+    # One owner-scoped account SELECT per POST, whether the labels are cached (lookup
+    # by id) or were just invalidated (the dropdown rows resolve the submitted id)
+    def account_selects_for_withdraw():
+        with count_queries() as statements:
+            client.post('/user/withdraw', data={'account': account_id, 'amount': 10.00})
+        return [s for s in statements if 'FROM accounts' in s and 'accounts.user_id = ?' in s]
+
+    assert len(account_selects_for_withdraw()) == 1
+    assert len(account_selects_for_withdraw()) == 1
+    assert '(₹130.00)' in client.get('/user/withdraw').get_data(as_text=True)
+
+def test_failed_transfer_leaves_both_balances(client):
+    """Test that a transfer whose credit runs first is rolled back when the debit fails"""
+    with client.application.app_context():
+        user = User(email='order@test.com', full_name='Order')
+        user.set_password('pass')
+        db.session.add(user)
+        db.session.flush()
+
+        # The destination has the lower id, so its credit is applied before the debit
+        destination = Account(user_id=user.id, account_number='7000000001', account_type='savings', balance=0)
+        db.session.add(destination)
+        db.session.flush()
+        source = Account(user_id=user.id, account_number='7000000002', account_type='savings', balance=500)
+        db.session.add(source)
+        db.session.commit()
+        source_id, destination_id = source.id, destination.id
+
+    client.post('/auth/login', data={'email': 'order@test.com', 'password': 'pass'})
+    response = client.post('/user/transfer', data={
+        'from_account': source_id,
+        'to_account_id': '7000000001',
+        'amount': 20.00
+    }, follow_redirects=True)
+    assert b'Insufficient balance' in response.data
+
+    with client.application.app_context():
+        assert db.session.get(Account, source_id).balance == 500
+        assert db.session.get(Account, destination_id).balance == 0